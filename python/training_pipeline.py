@@ -1,14 +1,19 @@
+import io
 import os
-import shutil
-import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+from functools import lru_cache
 import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
 import onnx
 import onnxruntime as ort
 from skl2onnx import to_onnx
 from skl2onnx.common.data_types import FloatTensorType
-import torch
-import torchvision.transforms.functional as TF
 from PIL import Image
+from scipy.linalg import solve
+from sklearn.decomposition import PCA
 from sklearn.linear_model import LogisticRegression
 from pocketbase import PocketBase
 from pocketbase.client import FileUpload
@@ -24,32 +29,219 @@ POCKETBASE_URL = "http://127.0.0.1:8090"
 ADMIN_EMAIL = os.getenv("ADMIN_EMAIL") # "your_admin_email@example.com"
 ADMIN_PASS = os.getenv("ADMIN_PASS") # "your_admin_password"
 DINOV3_MODEL_PATH = "../assets/dinov3_feature_extractor.onnx" 
+TRT_ENGINE_CACHE_DIR = os.path.join(os.path.dirname(DINOV3_MODEL_PATH), "trt_cache")
 
 # Constants
 PATCH_SIZE = 16
 IMAGE_SIZE = 768
 IMAGENET_MEAN = (0.485, 0.456, 0.406)
 IMAGENET_STD = (0.229, 0.224, 0.225)
+# (x / 255 - mean) / std precomputed for every uint8 value, one table per channel
+NORM_LUT = (
+    (np.arange(256, dtype=np.float32)[np.newaxis, :] / 255.0 - np.array(IMAGENET_MEAN, dtype=np.float32)[:, np.newaxis])
+    / np.array(IMAGENET_STD, dtype=np.float32)[:, np.newaxis]
+)
+DOWNLOAD_WORKERS = 16 # Concurrent image download + preprocessing workers (and pooled connections) per job
+FEATURE_BATCH_SIZE = 8 # Images per DINOv3 run (only images with the same input shape are batched)
+FEATURE_PCA_DIM = 128 # Principal components the classifier is trained on
+RIDGE_ALPHA = 1.0 # Regularization of the closed-form ridge fit that seeds the classifier
+# Input widths covered by the TensorRT engine: 1:2 portrait up to 2:1 landscape images.
+# Images outside this range still work, but make onnxruntime rebuild the engine.
+TRT_MIN_WIDTH = IMAGE_SIZE // 2
+TRT_MAX_WIDTH = IMAGE_SIZE * 2
 
 # --- ML HELPERS ---
-def preprocess_image(img_pil, image_size=IMAGE_SIZE, patch_size=PATCH_SIZE):
-    w, h = img_pil.size
+def trt_profile_shapes(model_path=DINOV3_MODEL_PATH):
+    # One profile covering every batch the op runs (partial flushes included) and every width
+    # in [TRT_MIN_WIDTH, TRT_MAX_WIDTH], so the cached engine is not rebuilt in the middle of a job
+    graph = onnx.load(model_path, load_external_data=False).graph
+    initializers = {init.name for init in graph.initializer}
+    model_input = next(i for i in graph.input if i.name not in initializers)
+    static_batch = model_input.type.tensor_type.shape.dim[0].dim_value
+    min_batch = static_batch or 1
+    max_batch = static_batch or FEATURE_BATCH_SIZE
+    def shape(batch, width):
+        return f"{model_input.name}:{batch}x3x{IMAGE_SIZE}x{width}"
+    return {
+        'trt_profile_min_shapes': shape(min_batch, TRT_MIN_WIDTH),
+        'trt_profile_opt_shapes': shape(max_batch, IMAGE_SIZE),
+        'trt_profile_max_shapes': shape(max_batch, TRT_MAX_WIDTH),
+    }
+
+def create_feature_session(model_path=DINOV3_MODEL_PATH):
+    sess_options = ort.SessionOptions()
+    sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    # intra_op_num_threads is left at ORT's default (physical cores) rather than every logical
+    # core, since the download/resize workers share the CPU with it
+    # Prefer TensorRT, then CUDA; both need the onnxruntime-gpu wheel (see README)
+    available = ort.get_available_providers()
+    providers = ['CPUExecutionProvider']
+    if 'CUDAExecutionProvider' in available:
+        providers.insert(0, ('CUDAExecutionProvider', {'cudnn_conv_algo_search': 'EXHAUSTIVE'}))
+    if 'TensorrtExecutionProvider' in available:
+        # FP16 engines are built once and cached next to the ONNX model for later runs
+        providers.insert(0, ('TensorrtExecutionProvider', {
+            'trt_fp16_enable': True,
+            'trt_engine_cache_enable': True,
+            'trt_engine_cache_path': TRT_ENGINE_CACHE_DIR,
+            **trt_profile_shapes(model_path),
+        }))
+    return ort.InferenceSession(model_path, sess_options=sess_options, providers=providers)
+
+_feature_session = None
+_feature_session_lock = threading.Lock()
+
+def get_feature_session():
+    # Loaded once per process and shared by every run executed in it (sessions are thread-safe to run)
+    global _feature_session
+    with _feature_session_lock:
+        if _feature_session is None:
+            _feature_session = create_feature_session()
+    return _feature_session
+
+@lru_cache(maxsize=None)
+def patch_aligned_size(w, h, image_size=IMAGE_SIZE, patch_size=PATCH_SIZE):
+    # (W, H) in PIL order: height fixed at image_size, width following the aspect ratio
     h_patches = image_size // patch_size
     w_patches = int((w * image_size) / (h * patch_size))
-    target_size = (h_patches * patch_size, w_patches * patch_size)
-    resized_img = img_pil.resize((target_size[1], target_size[0]), Image.Resampling.BICUBIC)
-    img_np = np.array(resized_img, dtype=np.float32) / 255.0
-    mean = np.array(IMAGENET_MEAN, dtype=np.float32)
-    std = np.array(IMAGENET_STD, dtype=np.float32)
-    normalized_img = (img_np - mean) / std
-    return normalized_img.transpose(2, 0, 1)[np.newaxis, :, :]
+    return (w_patches * patch_size, h_patches * patch_size)
+
+def resize_image(img_pil, image_size=IMAGE_SIZE, patch_size=PATCH_SIZE):
+    target_size = patch_aligned_size(*img_pil.size, image_size, patch_size)
+    resized_img = img_pil.resize(target_size, Image.Resampling.BICUBIC)
+    return np.asarray(resized_img, dtype=np.uint8) # [H, W, 3]
+
+def normalize_image(img_np, out):
+    # Writes the normalized [3, H, W] image into `out`, e.g. one slot of a batch buffer
+    for c in range(3):
+        # uint8 indices are always in range, so 'clip' lets take() write into out unbuffered
+        np.take(NORM_LUT[c], img_np[:, :, c], out=out[c], mode='clip')
+    return out
 
 def resize_mask(mask_pil, image_size=IMAGE_SIZE, patch_size=PATCH_SIZE):
-    w, h = mask_pil.size
-    h_patches = int(image_size / patch_size)
-    w_patches = int((w * image_size) / (h * patch_size))
-    target_size = (h_patches * patch_size, w_patches * patch_size)
-    return TF.to_tensor(TF.resize(mask_pil, target_size))
+    target_size = patch_aligned_size(*mask_pil.size, image_size, patch_size)
+    resized_mask = mask_pil.resize(target_size, Image.Resampling.BILINEAR)
+    return np.asarray(resized_mask, dtype=np.uint8) # [H, W]
+
+def quantize_mask(mask_np, patch_size=PATCH_SIZE):
+    # Average the uint8 mask over each patch, then scale the (much smaller) result to [0, 1]
+    h, w = mask_np.shape
+    patches = mask_np.reshape(h // patch_size, patch_size, w // patch_size, patch_size)
+    return patches.mean(axis=(1, 3), dtype=np.float32).ravel() * np.float32(1.0 / 255.0)
+
+def load_sample(img_bytes):
+    # Returns (resized_img, mask_quantized), or None for images without an alpha mask
+    with Image.open(io.BytesIO(img_bytes)) as img:
+        if img.mode != 'RGBA': return None
+        img.load()
+        # One pass over the RGBA buffer yields both the colour planes and the mask
+        r, g, b, mask_img = img.split()
+        rgb_img = Image.merge("RGB", (r, g, b))
+        
+        # Ground Truth
+        mask_quantized = quantize_mask(resize_mask(mask_img))
+        
+        # Input (normalized later, directly into the batch buffer)
+        resized_img = resize_image(rgb_img)
+        return resized_img, mask_quantized
+
+def extract_features(ort_sess, batch):
+    # batch: C-contiguous [Batch, 3, H, W] float32, passed to onnxruntime without a copy
+    feats = ort_sess.run(None, {ort_sess.get_inputs()[0].name: batch})[0]
+    return feats.reshape(-1, feats.shape[-1]) # [Batch * Num_Patches, Embed_Dim]
+
+class PatchDataset:
+    """
+    Preallocated (features, labels) buffers for the patches kept for training.
+    Kept rows are packed in place and the buffers only grow (geometrically) if
+    the initial capacity estimate is exceeded, so no final concatenate is needed.
+    """
+    def __init__(self, capacity):
+        self.size = 0
+        self.xs = None # Allocated on the first append, once the embedding dim is known
+        self.ys = np.empty(capacity, dtype=np.float32)
+
+    def append(self, feats, masks):
+        # Filter (Keep only clear foreground/background)
+        ys = np.concatenate(masks)
+        idx = np.flatnonzero((ys < 0.01) | (ys > 0.99))
+        n = len(idx)
+        if self.xs is None:
+            self.xs = np.empty((len(self.ys), feats.shape[1]), dtype=np.float32)
+        if self.size + n > len(self.ys):
+            self._grow(self.size + n)
+        # Gather the kept rows straight into the buffers. The indices are always
+        # valid, so 'clip' lets take() skip its temporary copy of the output.
+        np.take(feats, idx, axis=0, out=self.xs[self.size:self.size + n], mode='clip')
+        np.take(ys, idx, out=self.ys[self.size:self.size + n], mode='clip')
+        self.size += n
+
+    def _grow(self, min_capacity):
+        capacity = max(2 * len(self.ys), min_capacity)
+        xs = np.empty((capacity, self.xs.shape[1]), dtype=np.float32)
+        ys = np.empty(capacity, dtype=np.float32)
+        xs[:self.size] = self.xs[:self.size]
+        ys[:self.size] = self.ys[:self.size]
+        self.xs, self.ys = xs, ys
+
+    @property
+    def features(self):
+        return self.xs[:self.size]
+
+    @property
+    def labels(self):
+        return self.ys[:self.size]
+
+def ridge_init(zs, y, alpha=RIDGE_ALPHA):
+    # Closed-form ridge fit on +-1 targets: one Cholesky solve of (Z^T Z + alpha * I) w = Z^T t.
+    # PCA outputs are centred, so the intercept is just the mean target.
+    t = 2.0 * y - 1.0
+    gram = (zs.T @ zs).astype(np.float64)
+    gram.flat[::gram.shape[0] + 1] += alpha
+    coef = solve(gram, zs.T @ t, assume_a='pos')
+    return coef[np.newaxis, :], np.array([t.mean()])
+
+def fold_projection(clf, pca):
+    # Rewrites a classifier trained on PCA outputs as the equivalent classifier on raw features:
+    # w . ((x - mean) @ V.T) + b == (w @ V) . x + (b - (w @ V) . mean)
+    coef = clf.coef_ @ pca.components_
+    clf.intercept_ = clf.intercept_ - coef @ pca.mean_
+    clf.coef_ = coef
+    clf.n_features_in_ = coef.shape[1]
+    return clf
+
+# --- DOWNLOAD HELPERS ---
+def create_http_session(pool_size=DOWNLOAD_WORKERS):
+    # Keep-alive connections are shared by all download threads instead of reconnecting per file
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def download_bytes(session, url):
+    r = session.get(url)
+    r.raise_for_status()
+    return r.content
+
+def fetch_sample(session, url):
+    # Images are decoded straight from memory; nothing is written to disk
+    return load_sample(download_bytes(session, url))
+
+def fetch_samples(pool, session, urls, max_in_flight):
+    # Yields samples as they finish, with at most max_in_flight downloads submitted but not yet
+    # consumed, so a slow consumer (DINOv3 on CPU) doesn't let decoded images pile up in memory
+    urls = iter(urls)
+    pending = set()
+    while True:
+        for url in islice(urls, max_in_flight - len(pending)):
+            pending.add(pool.submit(fetch_sample, session, url))
+        if not pending:
+            return
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
 
 # --- DAGSTER OP (The Heavy Lifting) ---
 
@@ -72,101 +264,123 @@ def train_classifier_op(context):
     pb.collection('datasets').update(record_id, {"status": "training"})
 
     try:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            # Download Images
-            image_files = []
-            for filename in record.images:
-                file_url = pb.get_file_url(record, filename)
-                import requests
-                r = requests.get(file_url)
-                local_path = os.path.join(temp_dir, filename)
-                with open(local_path, 'wb') as f:
-                    f.write(r.content)
-                image_files.append(local_path)
-            
-            context.log.info(f"Downloaded {len(image_files)} images.")
+        # Extract Features (DINOv3) & Train
+        ort_sess = get_feature_session()
+        input_meta = ort_sess.get_inputs()[0]
+        # Exports without a dynamic batch axis are run one image at a time. A static batch > 1
+        # can't take the smaller buffers and partial batches used below.
+        static_batch = input_meta.shape[0] if isinstance(input_meta.shape[0], int) else None
+        if static_batch is not None and static_batch != 1:
+            raise ValueError(
+                f"{DINOV3_MODEL_PATH} has a static batch size of {static_batch}; "
+                "re-export it with a dynamic batch axis (or batch size 1)."
+            )
+        batch_size = static_batch or FEATURE_BATCH_SIZE
+        
+        # Download + preprocessing run in worker threads while this thread runs DINOv3 on
+        # whatever is ready. Images with the same aspect ratio resize to the same shape
+        # and share a batch buffer that is reused for as long as images can still arrive.
+        # buckets: {(H, W, 3): (inputs [<= batch_size, 3, H, W], masks)}
+        file_urls = [pb.get_file_url(record, filename) for filename in record.images]
+        # Sized for every patch of square images; only grows for wider inputs
+        patches = PatchDataset(len(file_urls) * (IMAGE_SIZE // PATCH_SIZE) ** 2)
+        buckets = {}
+        num_images = 0
+        num_seen = 0
+        with create_http_session() as http, ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as pool:
+            try:
+                for sample in fetch_samples(pool, http, file_urls, 2 * DOWNLOAD_WORKERS + batch_size):
+                    num_seen += 1
+                    if sample is None: continue
+                    num_images += 1
+                    resized_img, mask_quantized = sample
+                    shape = resized_img.shape
+                    # Images still to come (including this one) bound how full the batch can get
+                    num_left = len(file_urls) - num_seen + 1
+                    if shape not in buckets:
+                        inputs = np.empty((min(batch_size, num_left), 3) + shape[:2], dtype=np.float32)
+                        buckets[shape] = (inputs, [])
+                    inputs, masks = buckets[shape]
+                    normalize_image(resized_img, inputs[len(masks)])
+                    masks.append(mask_quantized)
+                    del sample, resized_img # Freed as soon as it has been copied into a batch
+                    if len(masks) == len(inputs):
+                        patches.append(extract_features(ort_sess, inputs), masks)
+                        masks.clear()
+                        # Release the buffer once fewer images remain than it holds;
+                        # a later image of this shape gets a smaller one
+                        if num_left - 1 < len(inputs):
+                            del buckets[shape]
+            except BaseException:
+                # Fail the job now instead of waiting for the remaining downloads
+                pool.shutdown(cancel_futures=True)
+                raise
 
-            # Extract Features (DINOv3) & Train
+        # Flush partially filled batches, releasing each buffer as it goes
+        while buckets:
+            _, (inputs, masks) = buckets.popitem()
+            if masks:
+                patches.append(extract_features(ort_sess, inputs[:len(masks)]), masks)
+        inputs = masks = None # Drop the last buffer reference before training
+        
+        context.log.info(f"Extracted features from {num_images} of {len(file_urls)} images.")
 
-            ort_sess = ort.InferenceSession(DINOV3_MODEL_PATH)
-            input_name = ort_sess.get_inputs()[0].name
-            
-            xs = []
-            ys = []
-            
-            patch_quant_filter = torch.nn.Conv2d(1, 1, PATCH_SIZE, stride=PATCH_SIZE, bias=False)
-            patch_quant_filter.weight.data.fill_(1.0 / (PATCH_SIZE * PATCH_SIZE))
-            
-            for img_path in image_files:
-                with Image.open(img_path) as img:
-                    if img.mode != 'RGBA': continue
-                    img.load()
-                    rgb_img = img.convert("RGB")
-                    mask_img = img.split()[-1]
-                    
-                    # Ground Truth
-                    mask_tensor = resize_mask(mask_img)
-                    mask_quantized = patch_quant_filter(mask_tensor).squeeze().view(-1).detach().numpy()
-                    ys.append(mask_quantized)
-                    
-                    # Input
-                    img_input = preprocess_image(rgb_img)
-                    
-                    # Inference
-                    feats = ort_sess.run(None, {input_name: img_input})[0]
-                    feats = feats.squeeze(0) # [Num_Patches, Embed_Dim]
-                    xs.append(feats)
-
-            # Concat
-            xs = np.concatenate(xs, axis=0)
-            ys = np.concatenate(ys, axis=0)
-            
-            # Filter (Keep only clear foreground/background)
-            idx = (ys < 0.01) | (ys > 0.99)
-            xs_clean = xs[idx]
-            ys_clean = ys[idx]
-
-            # Train Classifier
-            print("   Training Logistic Regression...")
-            # Fixed C=1.0 is usually fine for few-shot, or use simplified search
-            clf = LogisticRegression(C=1.0, max_iter=1000, n_jobs=-1)
-            clf.fit(xs_clean, (ys_clean > 0).astype(int))
-            
-            # Export using skl2onnx (Cleaner and lighter than `torch.onnx.export`)
-            print("   Exporting Classifier via skl2onnx...")
-    
-            # feature_dim is the size of the DINOv3 embeddings
-            feature_dim = xs_clean.shape[1]
-            # Define the input type and shape: 
-            # [None, feature_dim] allows for a dynamic number of patches 
-            initial_type = [('patch_features', FloatTensorType([None, feature_dim]))]
-
-            # Convert the scikit-learn model to ONNX
-            options = {type(clf): {'zipmap': False}}
-            onx = to_onnx(
-                clf, 
-                initial_types=[('patch_features', FloatTensorType([None, feature_dim]))],
-                options=options, # This forces a simple Tensor output
-                target_opset=17
-            )
+        # Views into the preallocated buffers (float32, no copy)
+        xs_clean = patches.features
+        ys_clean = patches.labels
 
-            output_path = os.path.join(temp_dir, "classifier.onnx")
-            with open(output_path, "wb") as f:
-                f.write(onx.SerializeToString())
-
-            print(f"✅ Model saved to {output_path}")
-            # Upload Result
-            context.log.info("Uploading classifier to PocketBase...")
-            pb.collection('datasets').update(
-                record_id,
-                {
-                    "status": "ready",
-                    "classifier_file": FileUpload(
-                        ("classifier.onnx", open(output_path, "rb"))
-                    )
-                }
-            )
-            context.log.info(f"✅ Job Complete for {record_id}")
+        # Train Classifier
+        print("   Training Logistic Regression...")
+        # feature_dim is the size of the DINOv3 embeddings
+        feature_dim = xs_clean.shape[1]
+        # Solve on the top principal components: D / FEATURE_PCA_DIM less work per iteration,
+        # and it regularizes the few-shot fit. copy=False centres the (unused after this) buffer in place.
+        pca = PCA(n_components=min(FEATURE_PCA_DIM, *xs_clean.shape), svd_solver='randomized', random_state=0, copy=False)
+        zs_clean = pca.fit_transform(xs_clean)
+        y_clean = (ys_clean > 0).astype(int)
+        # Fixed C=1.0 is usually fine for few-shot; lbfgs converges well within 200 iterations.
+        # lbfgs upcasts X to float64; on the FEATURE_PCA_DIM-wide PCA outputs that copy is small
+        clf = LogisticRegression(C=1.0, solver='lbfgs', max_iter=200, tol=1e-3, n_jobs=-1, warm_start=True)
+        # Start lbfgs from the ridge solution instead of zero so it needs far fewer iterations
+        clf.coef_, clf.intercept_ = ridge_init(zs_clean, y_clean)
+        clf.fit(zs_clean, y_clean)
+        # Fold the projection back in so the exported model still takes raw DINOv3 features
+        clf = fold_projection(clf, pca)
+        
+        # Export using skl2onnx (Cleaner and lighter than `torch.onnx.export`)
+        print("   Exporting Classifier via skl2onnx...")
+
+        # Define the input type and shape: 
+        # [None, feature_dim] allows for a dynamic number of patches 
+        initial_type = [('patch_features', FloatTensorType([None, feature_dim]))]
+
+        # Convert the scikit-learn model to ONNX
+        options = {type(clf): {'zipmap': False}}
+        onx = to_onnx(
+            clf, 
+            initial_types=initial_type,
+            options=options, # This forces a simple Tensor output
+            target_opset=17
+        )
+        # Record intermediate shapes in the graph so the mobile runtime doesn't have to infer them
+        onx = onnx.shape_inference.infer_shapes(onx)
+
+        # Serialized in memory and uploaded directly; nothing is written to disk
+        model_bytes = onx.SerializeToString()
+
+        print(f"✅ Model serialized ({len(model_bytes)} bytes)")
+        # Upload Result
+        context.log.info("Uploading classifier to PocketBase...")
+        pb.collection('datasets').update(
+            record_id,
+            {
+                "status": "ready",
+                "classifier_file": FileUpload(
+                    ("classifier.onnx", io.BytesIO(model_bytes))
+                )
+            }
+        )
+        context.log.info(f"✅ Job Complete for {record_id}")
 
     except Exception as e:
         context.log.error(f"❌ Training failed: {e}")